@@ -1,27 +1,179 @@
 import os
+import re
 import math
+import tempfile
+import threading
 import numpy as np
 from typing import List, Dict, Tuple, Optional
 from datetime import datetime
 
 import faiss
-from sentence_transformers import SentenceTransformer, CrossEncoder, util
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+import torch
+import onnxruntime as ort
+from sentence_transformers import SentenceTransformer, CrossEncoder, export_dynamic_quantized_onnx_model
+from transformers import AutoTokenizer
+from optimum.onnxruntime import ORTModelForSeq2SeqLM, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from fastapi import BackgroundTasks
 from sqlalchemy.orm import Session
 
-from .config import EMBEDDER_PATH, FAISS_INDEX_PATH, CORPUS_PATH, SEQ2SEQ_MODEL_PATH
+from .config import (
+    EMBEDDER_PATH, FAISS_INDEX_PATH, IVFPQ_INDEX_PATH, CORPUS_PATH, CORPUS_DATA_PATH, CORPUS_OFFSETS_PATH,
+    SEQ2SEQ_MODEL_PATH, SEQ2SEQ_ONNX_PATH, SEMANTIC_CACHE_PATH, WEB_CONCURRENCY,
+)
+from .corpus import MappedCorpus, load_corpus
+from .database import SessionLocal
+from .fileutils import atomic_path
 from .models import ChatHistory
+from .search_batcher import SearchBatcher
+from .semantic_cache import SemanticCache
+
+# ================================================================
+# FAISS INDEX (IVF-PQ)
+# ================================================================
+IVFPQ_FACTORY = "IVF256,PQ48"
+IVFPQ_MIN_TRAIN = 256 * 39  # faiss wants ~39 training points per centroid
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "8"))
+
+def load_index() -> faiss.Index:
+    """Load the IVF-PQ index, building it once from the flat index if needed."""
+    if not os.path.exists(IVFPQ_INDEX_PATH):
+        flat_index = faiss.read_index(FAISS_INDEX_PATH)
+        if flat_index.ntotal < IVFPQ_MIN_TRAIN:
+            # Too few vectors to train the coarse quantizer; keep the exact index
+            return flat_index
+        xb = flat_index.reconstruct_n(0, flat_index.ntotal)
+        ivf_index = faiss.index_factory(flat_index.d, IVFPQ_FACTORY, faiss.METRIC_INNER_PRODUCT)
+        ivf_index.train(xb)
+        ivf_index.add(xb)
+        with atomic_path(IVFPQ_INDEX_PATH) as tmp_path:
+            faiss.write_index(ivf_index, tmp_path)
+    # Memory-map the inverted lists read-only: workers share one copy through the
+    # page cache and only the probed cells are ever paged in
+    ivf_index = faiss.read_index(IVFPQ_INDEX_PATH, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    faiss.extract_index_ivf(ivf_index).nprobe = FAISS_NPROBE
+    return ivf_index
+
+# ================================================================
+# ONNX RUNTIME
+# ================================================================
+# Each worker process gets an equal share of the cores, so N workers do not
+# each spin up cpu_count threads per session and oversubscribe the machine
+INTRA_OP_THREADS = max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)
+
+def ort_session_options() -> ort.SessionOptions:
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    opts.intra_op_num_threads = INTRA_OP_THREADS
+    return opts
+
+def load_seq2seq_model() -> ORTModelForSeq2SeqLM:
+    """Load the INT8 ONNX T5, exporting and quantizing it once if needed."""
+    if not os.path.isdir(SEQ2SEQ_ONNX_PATH):
+        # The FP32 export is scratch space; only the quantized directory is kept
+        with atomic_path(SEQ2SEQ_ONNX_PATH) as quant_dir, tempfile.TemporaryDirectory(
+            dir=os.path.dirname(SEQ2SEQ_ONNX_PATH)
+        ) as export_dir:
+            exported = ORTModelForSeq2SeqLM.from_pretrained(
+                SEQ2SEQ_MODEL_PATH, export=True, use_cache=True, use_merged=True
+            )
+            exported.save_pretrained(export_dir)
+
+            # Dynamic INT8 quantization of the encoder and the merged decoder-with-past
+            qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+            for file_name in sorted(os.listdir(export_dir)):
+                if file_name.endswith(".onnx"):
+                    quantizer = ORTQuantizer.from_pretrained(export_dir, file_name=file_name)
+                    quantizer.quantize(save_dir=quant_dir, quantization_config=qconfig, file_suffix=None)
+            exported.config.save_pretrained(quant_dir)
+            exported.generation_config.save_pretrained(quant_dir)
+
+    return ORTModelForSeq2SeqLM.from_pretrained(
+        SEQ2SEQ_ONNX_PATH, use_cache=True, use_merged=True, session_options=ort_session_options()
+    )
+
+EMBEDDER_ONNX_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+def load_embedder() -> SentenceTransformer:
+    """Load the INT8 ONNX sentence embedder, quantizing it once if needed."""
+    onnx_path = os.path.join(EMBEDDER_PATH, EMBEDDER_ONNX_FILE)
+    if not os.path.exists(onnx_path):
+        # Quantize into scratch space, then publish the single file atomically
+        os.makedirs(os.path.dirname(onnx_path), exist_ok=True)
+        with atomic_path(onnx_path) as tmp_path, tempfile.TemporaryDirectory(
+            dir=os.path.dirname(onnx_path)
+        ) as scratch_dir:
+            fp32_embedder = SentenceTransformer(EMBEDDER_PATH, backend="onnx")
+            export_dynamic_quantized_onnx_model(fp32_embedder, "avx512_vnni", scratch_dir)
+            os.replace(os.path.join(scratch_dir, EMBEDDER_ONNX_FILE), tmp_path)
+    return SentenceTransformer(
+        EMBEDDER_PATH,
+        backend="onnx",
+        model_kwargs={"file_name": EMBEDDER_ONNX_FILE, "session_options": ort_session_options()},
+    )
 
 # ================================================================
 # LOAD MODELS
 # ================================================================
-embedder = SentenceTransformer(EMBEDDER_PATH)
-index = faiss.read_index(FAISS_INDEX_PATH)
-corpus_texts = np.load(CORPUS_PATH, allow_pickle=True)
-reranker = CrossEncoder("cross-encoder/ms-marco-MiniLM-L-6-v2")
+# Populated by init_models(), once per process. ONNX Runtime sessions and the
+# torch/OpenMP thread pools are not fork-safe, so nothing is loaded before a
+# fork: each worker builds its own sessions, while the index and corpus are
+# memory-mapped files that workers already share through the page cache.
+embedder: Optional[SentenceTransformer] = None
+index: Optional[faiss.Index] = None
+search_batcher: Optional[SearchBatcher] = None
+corpus_texts: Optional[MappedCorpus] = None
+reranker: Optional[CrossEncoder] = None
+tokenizer = None
+seq2seq_model: Optional[ORTModelForSeq2SeqLM] = None
+semantic_cache: Optional[SemanticCache] = None
+_prefix_ids: List[int] = []
+_context_open_ids: List[int] = []
+
+_models_lock = threading.Lock()
+_models_pid: Optional[int] = None
+
+def init_models():
+    global embedder, index, search_batcher, corpus_texts, reranker, tokenizer, seq2seq_model
+    global semantic_cache, _prefix_ids, _context_open_ids, _models_pid
+    # Keyed on the pid so a process forked after loading (e.g. gunicorn --preload)
+    # builds fresh sessions instead of reusing ones whose threads did not survive
+    if _models_pid == os.getpid():
+        return
+    with _models_lock:
+        if _models_pid == os.getpid():
+            return
+
+        faiss.omp_set_num_threads(INTRA_OP_THREADS)
+        embedder = load_embedder()
+        index = load_index()
+        search_batcher = SearchBatcher(index, max_batch=SEARCH_BATCH_SIZE, max_wait=SEARCH_BATCH_WAIT_S)
+        corpus_texts = load_corpus(CORPUS_PATH, CORPUS_DATA_PATH, CORPUS_OFFSETS_PATH)
 
-tokenizer = AutoTokenizer.from_pretrained(SEQ2SEQ_MODEL_PATH)
-seq2seq_model = AutoModelForSeq2SeqLM.from_pretrained(SEQ2SEQ_MODEL_PATH)
+        # Reranker runs on ONNX Runtime with the dynamically quantized INT8 (VNNI) export
+        reranker = CrossEncoder(
+            "cross-encoder/ms-marco-MiniLM-L-6-v2",
+            backend="onnx",
+            model_kwargs={
+                "file_name": "onnx/model_qint8_avx512_vnni.onnx",
+                "session_options": ort_session_options(),
+            },
+        )
+
+        tokenizer = AutoTokenizer.from_pretrained(SEQ2SEQ_MODEL_PATH)
+        # Constant pieces of the generation prompt, tokenized once
+        _prefix_ids, _context_open_ids = tokenizer(
+            ["Answer this health question:", "[CONTEXT:"], add_special_tokens=False
+        ).input_ids
+        seq2seq_model = load_seq2seq_model()
+
+        semantic_cache = SemanticCache(
+            embedder.get_sentence_embedding_dimension(),
+            threshold=CACHE_SIM_THRESHOLD,
+            max_size=MAX_CACHE_SIZE,
+            path=SEMANTIC_CACHE_PATH,
+        )
+        _models_pid = os.getpid()
 
 # ================================================================
 # CONFIGURATION
@@ -31,10 +183,15 @@ RERANK_THRESHOLD = 0.35
 MIN_COS_SIM = 0.1
 MAX_PROMPT_TOKENS = 10240
 RECENT_MESSAGES_LIMIT = 500
+CACHE_SIM_THRESHOLD = 0.92
+MAX_CACHE_SIZE = 2000
+SEARCH_BATCH_SIZE = 32
+SEARCH_BATCH_WAIT_S = 0.005
 
 CRISIS_KEYWORDS = {
     "suicid", "kill myself", "harm myself", "self-harm", "overdose", "hurt myself","pregancy"
 }
+_CRISIS_RE = re.compile("|".join(map(re.escape, CRISIS_KEYWORDS)), re.IGNORECASE)
 
 SYSTEM_PROMPT = (
     "You are a concise, factual, and empathetic health assistant. "
@@ -46,37 +203,47 @@ SYSTEM_PROMPT = (
 # ================================================================
 # HELPERS
 # ================================================================
-def num_tokens(text: str) -> int:
-    return len(tokenizer.encode(text, add_special_tokens=False))
-
 def contains_crisis(text: str) -> bool:
-    t = text.lower()
-    return any(k in t for k in CRISIS_KEYWORDS)
+    return _CRISIS_RE.search(text) is not None
 
 # ================================================================
 # DATABASE HELPERS
 # ================================================================
 def get_session_history(session_id: int, db: Session, limit: int = 1000) -> List[Dict]:
+    # Newest `limit` messages via the (session_id, timestamp) index, returned oldest first
     rows = (
         db.query(ChatHistory)
         .filter(ChatHistory.session_id == session_id)
-        .order_by(ChatHistory.timestamp.asc())
+        .order_by(ChatHistory.timestamp.desc())
         .limit(limit)
         .all()
     )
-    return [{"id": r.id, "role": r.role, "message": r.message, "score": r.score} for r in rows]
+    return [{"id": r.id, "role": r.role, "message": r.message, "score": r.score} for r in reversed(rows)]
 
 def save_reward_to_db(db: Session, message_id: int, reward: float):
-    msg = db.query(ChatHistory).filter(ChatHistory.id == message_id).first()
-    if msg:
-        msg.score = reward
-        db.commit()
+    # Single UPDATE statement; no SELECT or ORM row materialization
+    db.query(ChatHistory).filter(ChatHistory.id == message_id).update({"score": reward}, synchronize_session=False)
+    db.commit()
+
+def save_reward_in_background(message_id: int, reward: float):
+    # Background tasks run after the response is sent, so use a dedicated session
+    db = SessionLocal()
+    try:
+        save_reward_to_db(db, message_id, reward)
+    finally:
+        db.close()
 
 # ================================================================
 # REWARD COMPUTATION
 # ================================================================
 def compute_reward(answer: str, retrieved: Optional[str], feedback: Optional[int] = None) -> float:
-    sim = util.cos_sim(embedder.encode(answer), embedder.encode(retrieved)).item() if retrieved else 0.0
+    init_models()
+    if retrieved:
+        # One batched forward pass; normalized embeddings make cosine a dot product
+        embs = embedder.encode([answer, retrieved], batch_size=2, convert_to_numpy=True, normalize_embeddings=True)
+        sim = float(embs[0] @ embs[1])
+    else:
+        sim = 0.0
     auto_reward = 2 * sim - 1  # map 0–1 → -1–1
     if feedback is not None:
         reward = 0.7 * feedback + 0.3 * auto_reward
@@ -87,39 +254,62 @@ def compute_reward(answer: str, retrieved: Optional[str], feedback: Optional[int
 # ================================================================
 # RETRIEVAL & RERANKING
 # ================================================================
-def retrieve_top_k(query: str, k: int = DEFAULT_TOP_K) -> Tuple[List[str], np.ndarray]:
-    q_emb = embedder.encode([query], convert_to_numpy=True)
-    faiss.normalize_L2(q_emb)
-    D, I = index.search(q_emb, k)
-    return [corpus_texts[idx] for idx in I[0]], D[0]
+def encode_question(question: str) -> np.ndarray:
+    # Unit-norm embeddings, so inner product is cosine without faiss.normalize_L2
+    return embedder.encode([question], convert_to_numpy=True, normalize_embeddings=True)
+
+def retrieve_top_k(
+    query: str, k: int = DEFAULT_TOP_K, q_emb: Optional[np.ndarray] = None
+) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    if q_emb is None:
+        q_emb = encode_question(query)
+    # Coalesced with concurrent requests into one batched index.search
+    D, I = search_batcher.search(q_emb, k)
+    # IVF search pads with -1 when the probed cells hold fewer than k vectors
+    found = I[0] >= 0
+    return corpus_texts.take(I[0][found]), D[0][found], q_emb
 
-def rerank_and_select(question: str, candidates: List[str]) -> Tuple[Optional[str], float, List[float]]:
+def rerank_and_select(question: str, candidates: List[str]) -> Tuple[Optional[str], float, np.ndarray]:
     if not candidates:
-        return None, 0.0, []
-    pairs = [[question, c] for c in candidates]
-    scores = reranker.predict(pairs)
-    best_idx = int(np.argmax(scores))
+        return None, 0.0, np.empty(0, dtype=np.float32)
+    # Tokenize all (question, passage) pairs as one padded batch and score them
+    # in a single forward pass, bypassing CrossEncoder.predict's DataLoader
+    features = reranker.tokenizer(
+        [question] * len(candidates),
+        candidates,
+        padding=True,
+        truncation=True,
+        max_length=512,
+        return_tensors="pt",
+    )
+    logits = reranker.model(**features).logits.squeeze(-1)
+    scores = np.asarray(reranker.activation_fn(logits), dtype=np.float32)
+    best_idx = int(scores.argmax())
     best_score = float(scores[best_idx])
     if best_score < RERANK_THRESHOLD:
-        return None, best_score, list(scores)
-    return candidates[best_idx], best_score, list(scores)
+        return None, best_score, scores
+    return candidates[best_idx], best_score, scores
 
 # ================================================================
 # GENERATION FUNCTION (UPDATED)
 # ================================================================
 def generate_answer(question: str, context: str) -> str:
     """Generate high-quality, controlled answers."""
-    prompt = f"Answer this health question: {question} [CONTEXT: {context}]"
-    inputs = tokenizer(prompt, return_tensors='pt', truncation=True, max_length=512).to(seq2seq_model.device)
+    # Prompt: "Answer this health question: {question} [CONTEXT: {context}]".
+    # SentencePiece marks word starts with "▁", so tokenizing the whitespace-separated
+    # pieces on their own gives the same ids; only question and context are tokenized here.
+    question_ids, context_ids = tokenizer([question, f"{context}]"], add_special_tokens=False).input_ids
+    ids = (_prefix_ids + question_ids + _context_open_ids + context_ids)[:511] + [tokenizer.eos_token_id]
+    input_ids = torch.tensor([ids], device=seq2seq_model.device)
+    inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
 
     out = seq2seq_model.generate(
         **inputs,
-        max_length=256,
+        max_new_tokens=128,
         num_beams=4,
         early_stopping=True,
-        no_repeat_ngram_size=1,
+        no_repeat_ngram_size=3,
         length_penalty=0.1,
-        temperature=0.8,
         do_sample=False,
     )
     gen_ans = tokenizer.decode(out[0], skip_special_tokens=True)
@@ -128,12 +318,20 @@ def generate_answer(question: str, context: str) -> str:
 # ================================================================
 # MAIN CHAT LOGIC (WITH MEMORY)
 # ================================================================
-def answer_with_memory(session_id: int, question: str, db: Session, top_k: int = DEFAULT_TOP_K) -> Dict:
+def answer_with_memory(
+    session_id: int,
+    question: str,
+    db: Session,
+    top_k: int = DEFAULT_TOP_K,
+    background_tasks: Optional[BackgroundTasks] = None,
+) -> Dict:
+    init_models()
     history = get_session_history(session_id, db)
     context_messages = [{"role": m["role"], "message": m["message"]} for m in history]
 
     # Crisis detection
-    if contains_crisis(question) or any(contains_crisis(m["message"]) for m in context_messages[-3:]):
+    # Single regex pass over the question and the last few messages
+    if contains_crisis("\n".join([question] + [m["message"] for m in context_messages[-3:]])):
         return {
             "answer": (
                 "If you are thinking about harming yourself or others, please seek immediate help. "
@@ -146,38 +344,47 @@ def answer_with_memory(session_id: int, question: str, db: Session, top_k: int =
             "source": None,
         }
 
-    # Retrieve and rerank
-    candidates, _ = retrieve_top_k(question, k=top_k)
-    best_passage, best_score, _ = rerank_and_select(question, candidates)
+    # Semantic cache: reuse the answer of a near-duplicate question
+    q_emb = encode_question(question)
+    cached = semantic_cache.lookup(q_emb)
 
-    # Fallback on low confidence
-    if best_passage is None or best_score < RERANK_THRESHOLD:
-        return {
-            "answer": "I'm not sure about that. Please consult a qualified health professional or provide more details.",
-            "score": best_score,
-            "source": None,
-            "flagged": False,
-        }
+    if cached is None:
+        # Retrieve and rerank
+        candidates, _, _ = retrieve_top_k(question, k=top_k, q_emb=q_emb)
+        best_passage, best_score, _ = rerank_and_select(question, candidates)
 
-    # Generate controlled answer
-    gen_answer = generate_answer(question, best_passage)
-    reward_value = compute_reward(gen_answer, best_passage)
+        # Fallback on low confidence
+        if best_passage is None:
+            return {
+                "answer": "I'm not sure about that. Please consult a qualified health professional or provide more details.",
+                "score": best_score,
+                "source": None,
+                "flagged": False,
+            }
 
-    # Save reward
-    last_message = (
-        db.query(ChatHistory)
-        .filter(ChatHistory.session_id == session_id)
-        .order_by(ChatHistory.timestamp.desc())
-        .first()
-    )
-    if last_message:
-        save_reward_to_db(db, last_message.id, reward_value)
+        # Generate controlled answer
+        gen_answer = generate_answer(question, best_passage)
+        reward_value = compute_reward(gen_answer, best_passage)
+        cached = {"answer": gen_answer, "score": best_score, "source": best_passage, "reward": reward_value}
+        semantic_cache.add(q_emb, cached)
+    elif cached.get("reward") is None:
+        # Entry came from answer_stateless; store the reward so later hits reuse it
+        cached["reward"] = compute_reward(cached["answer"], cached["source"])
+        semantic_cache.update(cached["cache_id"], reward=cached["reward"])
+
+    # Save reward on the latest message, already loaded with the history
+    last_message_id = history[-1]["id"] if history else None
+    if last_message_id:
+        if background_tasks is not None:
+            background_tasks.add_task(save_reward_in_background, last_message_id, cached["reward"])
+        else:
+            save_reward_to_db(db, last_message_id, cached["reward"])
 
     return {
-        "answer": gen_answer,
-        "score": best_score,
-        "source": best_passage,
-        "reward": reward_value,
+        "answer": cached["answer"],
+        "score": cached["score"],
+        "source": cached["source"],
+        "reward": cached["reward"],
         "flagged": False,
     }
 
@@ -185,13 +392,20 @@ def answer_with_memory(session_id: int, question: str, db: Session, top_k: int =
 # STATELESS MODE
 # ================================================================
 def answer_stateless(question: str, top_k: int = DEFAULT_TOP_K) -> Dict:
-    candidates, _ = retrieve_top_k(question, k=top_k)
+    init_models()
+    q_emb = encode_question(question)
+    cached = semantic_cache.lookup(q_emb)
+    if cached is not None:
+        return {"answer": cached["answer"], "score": cached["score"], "source": cached["source"]}
+
+    candidates, _, _ = retrieve_top_k(question, k=top_k, q_emb=q_emb)
     best_passage, best_score, _ = rerank_and_select(question, candidates)
 
-    if best_passage is None or best_score < RERANK_THRESHOLD:
+    if best_passage is None:
         return {"answer": "I’m not confident enough to answer that. Please consult a healthcare provider.", "score": best_score, "source": None}
 
     gen_answer = generate_answer(question, best_passage)
+    semantic_cache.add(q_emb, {"answer": gen_answer, "score": best_score, "source": best_passage, "reward": None})
     return {"answer": gen_answer, "score": best_score, "source": best_passage}
 
 print("✅ Chatbot updated with enhanced cross-encoder reranking and controlled generation.")
@@ -1,18 +1,24 @@
 import os
 from dotenv import load_dotenv
 from huggingface_hub import snapshot_download
-from sentence_transformers import SentenceTransformer
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Number of server worker processes; gunicorn also reads this as its default --workers
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
 HF_REPO = "lscblack/healthbot"
 base_dir = snapshot_download(repo_id=HF_REPO)
 
 EMBEDDER_PATH = os.path.join(base_dir, "embedder_allMiniLM")
 SEQ2SEQ_MODEL_PATH = os.path.join(base_dir, "t5_health_final")
+SEQ2SEQ_ONNX_PATH = os.getenv("SEQ2SEQ_ONNX_PATH", os.path.join(base_dir, "t5_health_onnx_int8"))
 FAISS_INDEX_PATH = os.path.join(base_dir, "faiss.index")
 CORPUS_PATH = os.path.join(base_dir, "corpus_texts.npy")
+CORPUS_DATA_PATH = os.getenv("CORPUS_DATA_PATH", os.path.join(base_dir, "corpus_data.bin"))
+CORPUS_OFFSETS_PATH = os.getenv("CORPUS_OFFSETS_PATH", os.path.join(base_dir, "corpus_offsets.npy"))
+IVFPQ_INDEX_PATH = os.getenv("IVFPQ_INDEX_PATH", os.path.join(base_dir, "faiss_ivfpq.index"))
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", os.path.join(base_dir, "semantic_cache.json"))
 
-embedder = SentenceTransformer(EMBEDDER_PATH)
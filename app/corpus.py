@@ -0,0 +1,47 @@
+import os
+from typing import List
+
+import numpy as np
+
+from .fileutils import atomic_path
+
+"""
+Memory-mapped answer corpus.
+
+Texts are stored as one UTF-8 blob (data.bin) plus an int64 offsets array
+(offsets.npy, length N+1). Both files are mapped read-only, so looking up a
+passage is pointer arithmetic on pages the kernel shares across workers.
+"""
+
+def build_mapped_corpus(corpus_path: str, data_path: str, offsets_path: str):
+    """One-time conversion of the pickled corpus_texts.npy into data/offsets files."""
+    texts = np.load(corpus_path, allow_pickle=True)
+    encoded = [str(t).encode("utf-8") for t in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+
+    with atomic_path(data_path) as tmp_data, atomic_path(offsets_path) as tmp_offsets:
+        with open(tmp_data, "wb") as f:
+            f.write(b"".join(encoded))
+        with open(tmp_offsets, "wb") as f:
+            np.save(f, offsets)
+
+class MappedCorpus:
+    def __init__(self, data_path: str, offsets_path: str):
+        self.offsets = np.load(offsets_path, mmap_mode="r")
+        self.data = np.memmap(data_path, dtype=np.uint8, mode="r")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> str:
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return bytes(self.data[start:end]).decode("utf-8")
+
+    def take(self, ids: np.ndarray) -> List[str]:
+        return [self[int(i)] for i in ids]
+
+def load_corpus(corpus_path: str, data_path: str, offsets_path: str) -> MappedCorpus:
+    if not (os.path.exists(data_path) and os.path.exists(offsets_path)):
+        build_mapped_corpus(corpus_path, data_path, offsets_path)
+    return MappedCorpus(data_path, offsets_path)
@@ -0,0 +1,27 @@
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+@contextmanager
+def atomic_path(final_path: str) -> Iterator[str]:
+    """
+    Yield a temp path next to final_path for the caller to write a file or
+    directory to. On success it is renamed into place with os.replace, so
+    readers only ever see a complete result; on failure it is removed.
+    """
+    tmp_path = f"{final_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        yield tmp_path
+        try:
+            os.replace(tmp_path, final_path)
+        except OSError:
+            # A non-empty directory cannot be replaced: another process published it first
+            if not os.path.isdir(final_path):
+                raise
+    finally:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
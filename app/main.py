@@ -9,6 +9,9 @@ from fastapi.middleware.cors import CORSMiddleware
 app = FastAPI(title="Health Chatbot API", version="1.0.0")
 models.Base.metadata.create_all(bind=database.engine)
 
+# Load models at import; each worker process imports the app and loads its own
+chatbot.init_models()
+
 # Configure CORS 
 app.add_middleware(
     CORSMiddleware,
@@ -54,7 +57,7 @@ def get_chat_history(session_id: int, db: Session = Depends(get_db)):
 
 # UPDATED CHAT ENDPOINT - Handles session creation automatically
 @app.post("/api/chat", response_model=schemas.ChatResponse)
-def chat(req: schemas.ChatRequest, db: Session = Depends(get_db)):
+def chat(req: schemas.ChatRequest, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     """
     Chat with the model. Creates a new session if none exists or provided.
     """
@@ -81,7 +84,7 @@ def chat(req: schemas.ChatRequest, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Session not found")
     
     # Generate answer with session memory
-    res = chatbot.answer_with_memory(session_id, req.message, db)
+    res = chatbot.answer_with_memory(session_id, req.message, db, background_tasks=background_tasks)
 
     # Save user message
     user_msg = crud.create_message(db, session_id, req.user_id, "user", req.message)
@@ -101,7 +104,7 @@ def chat(req: schemas.ChatRequest, db: Session = Depends(get_db)):
     return res
 
 @app.put("/api/chat/edit/{msg_id}", response_model=schemas.ChatResponse)
-def edit_and_resend(msg_id: int, request: dict, db: Session = Depends(get_db)):
+def edit_and_resend(msg_id: int, request: dict, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     """Edit a message and regenerate response"""
     new_message = request.get("new_message")
     if not new_message:
@@ -112,7 +115,7 @@ def edit_and_resend(msg_id: int, request: dict, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Message not found")
 
     # Regenerate using session memory
-    res = chatbot.answer_with_memory(msg.session_id, new_message, db)
+    res = chatbot.answer_with_memory(msg.session_id, new_message, db, background_tasks=background_tasks)
 
     # Save assistant response
     crud.create_message(
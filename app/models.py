@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, Float, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, Float, DateTime, ForeignKey, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from .database import Base
@@ -23,6 +23,8 @@ class ChatHistory(Base):
 
     session = relationship("ChatSession", back_populates="messages")
 
+    __table_args__ = (Index("ix_chat_history_session_timestamp", "session_id", "timestamp"),)
+
 class Feedback(Base):
     __tablename__ = "feedback"
     id = Column(Integer, primary_key=True, index=True)
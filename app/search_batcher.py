@@ -0,0 +1,71 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Tuple
+
+import faiss
+import numpy as np
+
+"""
+Micro-batching front end for FAISS searches.
+
+Concurrent requests post their query embeddings to a queue; a single worker
+thread drains up to max_batch queries (or whatever arrives within max_wait
+seconds), runs them as one index.search call and hands each caller its rows.
+"""
+
+class SearchBatcher:
+    def __init__(self, index: faiss.Index, max_batch: int = 32, max_wait: float = 0.005):
+        self.index = index
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self):
+        # Threads do not survive fork(), so each worker process starts its own
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid != pid:
+                self._queue = queue.Queue()
+                threading.Thread(target=self._run, args=(self._queue,), daemon=True).start()
+                self._pid = pid
+
+    def search(self, q_emb: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((q_emb, k, future))
+        return future.result()
+
+    def _run(self, requests: queue.Queue):
+        while True:
+            batch = [requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # Search once with the largest k; a smaller k is a prefix of the same ranking
+            k = max(item_k for _, item_k, _ in batch)
+            try:
+                D, I = self.index.search(np.vstack([q for q, _, _ in batch]), k)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            row = 0
+            for q, item_k, future in batch:
+                n = len(q)
+                future.set_result((D[row:row + n, :item_k], I[row:row + n, :item_k]))
+                row += n
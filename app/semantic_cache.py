@@ -0,0 +1,134 @@
+import os
+import json
+import base64
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import faiss
+import numpy as np
+
+from .fileutils import atomic_path
+
+"""
+In-process semantic cache for generated answers.
+
+Questions are keyed by their normalized embedding; a lookup returns the cached
+answer of the closest previous question when the cosine similarity clears the
+threshold. Entries are evicted least-recently-used once max_size is reached.
+
+The index and its entries are persisted together in one JSON file, replaced
+atomically, so a reader never pairs one process's index with another's entries.
+"""
+
+class SemanticCache:
+    def __init__(
+        self,
+        dim: int,
+        threshold: float = 0.92,
+        max_size: int = 2000,
+        path: Optional[str] = None,
+        save_every: int = 50,
+    ):
+        self.dim = dim
+        self.threshold = threshold
+        self.max_size = max_size
+        self.path = path
+        self.save_every = save_every
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+        self.entries: "OrderedDict[int, Dict]" = OrderedDict()
+        self._next_id = 0
+        self._unsaved = 0
+        self._saving = False
+        self._lock = threading.Lock()
+        if path:
+            self.load()
+
+    def lookup(self, q_emb: np.ndarray) -> Optional[Dict]:
+        """Return a copy of the closest cached result (with its "cache_id"), or None on a miss."""
+        with self._lock:
+            if self.index.ntotal == 0:
+                return None
+            D, I = self.index.search(q_emb, 1)
+            entry_id = int(I[0][0])
+            if entry_id < 0 or D[0][0] < self.threshold or entry_id not in self.entries:
+                return None
+            self.entries.move_to_end(entry_id)
+            return {**self.entries[entry_id], "cache_id": entry_id}
+
+    def add(self, q_emb: np.ndarray, result: Dict):
+        snapshot = None
+        with self._lock:
+            if len(self.entries) >= self.max_size:
+                oldest_id, _ = self.entries.popitem(last=False)
+                self.index.remove_ids(np.array([oldest_id], dtype=np.int64))
+            entry_id = self._next_id
+            self._next_id += 1
+            self.index.add_with_ids(q_emb, np.array([entry_id], dtype=np.int64))
+            self.entries[entry_id] = dict(result)
+            self._unsaved += 1
+            if self.path and self._unsaved >= self.save_every and not self._saving:
+                snapshot = self._snapshot()
+                self._saving = True
+        if snapshot is not None:
+            # Serialize and write off the request thread; lookups only wait for the snapshot copy
+            threading.Thread(target=self._write_in_background, args=(snapshot,), daemon=True).start()
+
+    def update(self, entry_id: int, **fields):
+        """Merge fields into a cached entry, e.g. a reward computed after a hit."""
+        with self._lock:
+            if entry_id in self.entries:
+                self.entries[entry_id].update(fields)
+
+    def save(self):
+        with self._lock:
+            snapshot = self._snapshot()
+        self._write(snapshot)
+
+    def _snapshot(self) -> Dict:
+        # Called with self._lock held: copy state so the write can run unlocked
+        self._unsaved = 0
+        return {
+            "dim": self.dim,
+            "next_id": self._next_id,
+            "index": faiss.serialize_index(self.index),
+            "entries": [(k, dict(v)) for k, v in self.entries.items()],
+        }
+
+    def _write(self, snapshot: Dict):
+        payload = {**snapshot, "index": base64.b64encode(snapshot["index"].tobytes()).decode("ascii")}
+        with atomic_path(self.path) as tmp_path:
+            with open(tmp_path, "w") as f:
+                json.dump(payload, f)
+
+    def _write_in_background(self, snapshot: Dict):
+        try:
+            self._write(snapshot)
+        finally:
+            with self._lock:
+                self._saving = False
+
+    def load(self):
+        """Load the persisted cache; a missing, corrupt or inconsistent file is ignored."""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                payload = json.load(f)
+            raw = np.frombuffer(base64.b64decode(payload["index"]), dtype=np.uint8)
+            index = faiss.deserialize_index(raw)
+            entries = OrderedDict((int(k), v) for k, v in payload["entries"])
+        except (OSError, ValueError, KeyError, RuntimeError):
+            return
+
+        ids = faiss.vector_to_array(index.id_map)
+        if (
+            payload.get("dim") != self.dim
+            or index.d != self.dim
+            or index.ntotal != len(entries)
+            or set(ids.tolist()) != set(entries)
+        ):
+            return
+        self.index = index
+        self.entries = entries
+        self._next_id = max(int(payload["next_id"]), max(entries, default=-1) + 1)